@@ -3,12 +3,14 @@
 # license that can be found in the LICENSE file.
 
 
+from collections import defaultdict
 from datetime import datetime
 
 from chroma_agent.lib.shell import AgentShell
 from chroma_agent.device_plugins.block_devices import (
-    get_normalized_device_table,
-    get_local_mounts,
+    parse_sys_block,
+    parse_local_mounts,
+    scanner_cmd,
 )
 from iml_common.blockdevices.blockdevice import BlockDevice
 from chroma_agent.log import daemon_log
@@ -31,6 +33,16 @@ class LocalTargets(object):
         # when we see a combined MGS+MDT
         uuid_name_to_target = {}
 
+        if target_devices:
+            # Take a single device-scanner snapshot for the whole scan rather
+            # than a udevadm settle and socket round trip per device.
+            data = scanner_cmd("Stream")
+            ndp = parse_sys_block(data)
+            mounted_paths = frozenset(
+                ndp.normalized_device_path(path)
+                for path, _, _ in parse_local_mounts(data["localMounts"])
+            )
+
         for device in sorted(target_devices, cmp=LocalTargets.comparator):
             block_device = BlockDevice(device["type"], device["path"])
 
@@ -52,11 +64,7 @@ class LocalTargets(object):
 
             targets = block_device.targets(uuid_name_to_target, device, daemon_log)
 
-            ndp = get_normalized_device_table()
-
-            mounted = ndp.normalized_device_path(device["path"]) in set(
-                [ndp.normalized_device_path(path) for path, _, _ in get_local_mounts()]
-            )
+            mounted = ndp.normalized_device_path(device["path"]) in mounted_paths
 
             for name in targets.names:
                 daemon_log.info(
@@ -66,7 +74,7 @@ class LocalTargets(object):
 
                 try:
                     target_dict = uuid_name_to_target[(device["uuid"], name)]
-                    target_dict["devices"].append(device)
+                    target_dict["device_paths"].append(device["path"])
                 except KeyError:
                     target_dict = {
                         "name": name,
@@ -80,6 +88,12 @@ class LocalTargets(object):
 
         self.targets = uuid_name_to_target.values()
 
+        # Index of the discovered targets by name, so that callers looking
+        # for a particular target (e.g. the MGS) need not scan them all.
+        self.by_name = defaultdict(list)
+        for target in self.targets:
+            self.by_name[target["name"]].append(target)
+
     @classmethod
     def comparator(cls, a, b):
         value = cmp(a["type"], b["type"])
@@ -100,11 +114,11 @@ class MgsTargets(object):
         super(MgsTargets, self).__init__()
         self.filesystems = {}
 
-        mgs_target = None
-
-        for t in local_targets:
-            if t["name"] == "MGS" and t["mounted"]:
-                mgs_target = t
+        # The last mounted MGS wins, as it did when every target was scanned
+        mgs_target = next(
+            (t for t in reversed(local_targets.by_name.get("MGS", ())) if t["mounted"]),
+            None,
+        )
 
         if mgs_target:
             daemon_log.info("Searching Lustre logs for filesystems")
@@ -159,7 +173,7 @@ def detect_scan(target_devices=None):
         local_targets = LocalTargets(settings["target_devices"])
 
     # Return the discovered Lustre components on the target devices, may return emptiness.
-    mgs_targets = MgsTargets(local_targets.targets)
+    mgs_targets = MgsTargets(local_targets)
     return {
         "target_devices_saved_timestamp": timestamp,
         "local_targets": local_targets.targets,
@@ -13,7 +13,12 @@ import time
 import threading
 
 from chroma_agent.lib.shell import AgentShell
-from chroma_agent.lib.pacemaker import cibadmin, cibxpath, PacemakerConfig
+from chroma_agent.lib.pacemaker import (
+    cibadmin,
+    cibxpath,
+    PacemakerConfig,
+    PacemakerError,
+)
 from chroma_agent.log import daemon_log
 from manage_corosync import start_corosync, stop_corosync
 from chroma_agent.lib.pacemaker import pacemaker_running
@@ -34,22 +39,20 @@ pacemaker_service = ServiceControl.create("pacemaker")
 corosync_service = ServiceControl.create("corosync")
 
 
-def _get_cluster_size():
-    # you'd think there'd be a way to query the value of a property
-    # such as "expected-quorum-votes" but there does not seem to be, so
-    # just count nodes instead
+def _crm_nodes():
+    """
+    :return: a list of (node_id, name, status) tuples, one for each node listed by 'crm_node -l'
+    """
     rc, stdout, stderr = AgentShell.run_old(["crm_node", "-l"])
 
-    if not stdout:
-        return 0
+    return [tuple(line.split(" ", 2)) for line in stdout.splitlines() if line]
 
-    n = 0
-    for line in stdout.rstrip().split("\n"):
-        node_id, name, status = line.split(" ")
-        if status == "member" or status == "lost":
-            n = n + 1
 
-    return n
+def _get_cluster_size():
+    # you'd think there'd be a way to query the value of a property
+    # such as "expected-quorum-votes" but there does not seem to be, so
+    # just count nodes instead
+    return sum(1 for _, _, status in _crm_nodes() if status in ("member", "lost"))
 
 
 def start_pacemaker():
@@ -102,6 +105,9 @@ def _configure_pacemaker():
 
     timeout_time = time.time() + PACEMAKER_CONFIGURE_TIMEOUT
     error = None
+    # Poll quickly at first so that we notice the DC election (or the DC
+    # configuring pacemaker) promptly, then back off.
+    delay = 0.2
 
     while (pc.configured is False) and (time.time() < timeout_time):
         if pc.is_dc:
@@ -118,7 +124,8 @@ def _configure_pacemaker():
                 "Not configuring (global) pacemaker configuration because I am not the DC"
             )
 
-        time.sleep(10)
+        time.sleep(delay)
+        delay = min(delay * 1.5, 5.0)
 
     if pc.configured is False:
         error = "Failed to configure (global) pacemaker configuration dc=%s" % pc.dc
@@ -169,30 +176,19 @@ def _do_configure_pacemaker(pc):
         },
     )
 
-    def set_rsc_default(name, value):
-        """
-
-        :param name: attribute to set
-        :param value: value to set
-        :return: None if an error else a canned error message
-        """
-        return AgentShell.run_canned_error_message(
-            [
-                "crm_attribute",
-                "--type",
-                "rsc_defaults",
-                "--attr-name",
-                name,
-                "--attr-value",
-                value,
-            ]
+    # Set all the resource defaults in a single CIB update
+    try:
+        pc.create_update_rsc_defaults(
+            {
+                "resource-stickiness": "1000",
+                "failure-timeout": RSRC_FAIL_WINDOW,
+                "migration-threshold": RSRC_FAIL_MIGRATION_COUNT,
+            }
         )
+    except (AgentShell.CommandExecutionError, PacemakerError) as e:
+        return str(e)
 
-    return (
-        set_rsc_default("resource-stickiness", "1000")
-        or set_rsc_default("failure-timeout", RSRC_FAIL_WINDOW)
-        or set_rsc_default("migration-threshold", RSRC_FAIL_MIGRATION_COUNT)
-    )
+    return None
 
 
 def configure_fencing(agents):
@@ -272,13 +268,13 @@ def unconfigure_fencing():
 
 
 def delete_node(nodename):
-    rc, stdout, stderr = AgentShell.run_old(["crm_node", "-l"])
-    node_id = None
-    for line in stdout.split("\n"):
-        node_id, name, status = line.split(" ")
-        if name == nodename:
-            break
-    AgentShell.try_run(["crm_node", "--force", "-R", node_id])
+    node_id = next(
+        (node_id for node_id, name, _ in _crm_nodes() if name == nodename), None
+    )
+
+    if node_id is not None:
+        AgentShell.try_run(["crm_node", "--force", "-R", node_id])
+
     cibxpath("delete", '//nodes/node[@uname="{}"]'.format(nodename))
     cibxpath("delete", '//status/node_state[@uname="{}"]'.format(nodename))
 
@@ -3,14 +3,18 @@
 # license that can be found in the LICENSE file.
 
 import os
+import errno
 import time
 import re
 import socket
+import struct
+from random import choice
+from tempfile import mkstemp
 
 from jinja2 import Environment, PackageLoader
-from netaddr import IPNetwork, IPAddress
+from netaddr import IPNetwork
 from netaddr.core import AddrFormatError
-from urlparse import urljoin
+from urlparse import urljoin, urlparse
 
 from chroma_agent import config
 from chroma_agent.lib import node_admin
@@ -20,7 +24,7 @@ from iml_common.lib.firewall_control import FirewallControl
 from iml_common.lib.service_control import ServiceControl
 from chroma_agent.lib import networking
 from chroma_agent.lib.talker_thread import TalkerThread
-from scapy.all import sniff, UDP, IP
+from scapy.all import sniff, UDP
 
 env = Environment(loader=PackageLoader("chroma_agent", "templates"))
 
@@ -31,6 +35,19 @@ talker_thread = None
 
 operstate = "/sys/class/net/{}/operstate"
 
+# Egress device in the output of 'ip route get'
+IPROUTE_DEV_RE = re.compile(r"dev\s+(\S+)")
+
+# 10.0.0.0/8 and its upper half, 10.128.0.0/9, as 32-bit integers
+TEN_8 = 0x0A000000
+TEN_128 = 0x0A800000
+
+# Dotted-quad netmasks indexed by prefix length (0-32)
+PREFIX_TO_NETMASK = tuple(
+    socket.inet_ntoa(struct.pack("!I", (0xFFFFFFFF << (32 - i)) & 0xFFFFFFFF))
+    for i in range(33)
+)
+
 
 class RingDetectionError(Exception):
     pass
@@ -42,10 +59,19 @@ def get_all_interfaces():
     # Not sure how robust this will be; need to test with real gear.
     # In theory, should do the job to exclude IPoIB and lo interfaces.
     hwaddr_blacklist = ["00:00:00:00:00:00", "80:00:00:48:fe:80"]
+
+    # Fetch the details of every interface in one go, rather than having each
+    # CorosyncRingInterface query its own.
+    interfaces_info = dict(
+        (info.device, info) for info in ethtool.get_interfaces_info()
+    )
+
     eth_interfaces = []
     for device in ethtool.get_devices():
         if ethtool.get_hwaddr(device) not in hwaddr_blacklist:
-            eth_interfaces.append(CorosyncRingInterface(device))
+            eth_interfaces.append(
+                CorosyncRingInterface(device, info=interfaces_info.get(device))
+            )
 
     return eth_interfaces
 
@@ -53,24 +79,20 @@ def get_all_interfaces():
 def generate_ring1_network(ring0):
     # find a good place for the ring1 network
     subnet = find_subnet(ring0.ipv4_network, ring0.ipv4_prefixlen)
-    address = str(
-        IPAddress(
-            (int(IPAddress(ring0.ipv4_hostmask)) & int(IPAddress(ring0.ipv4_address)))
-            | int(subnet.ip)
-        )
-    )
+    # Keep ring0's host part and move it into the ring1 subnet
+    hostmask = struct.unpack("!I", socket.inet_aton(ring0.ipv4_hostmask))[0]
+    host = struct.unpack("!I", socket.inet_aton(ring0.ipv4_address))[0] & hostmask
+    address = socket.inet_ntoa(struct.pack("!I", host | int(subnet.ip)))
     console_log.info("Chose %s/%d for ring1 address" % (address, subnet.prefixlen))
     return address, str(subnet.prefixlen)
 
 
 def get_shared_ring():
     # The shared ring will always be on the interface used for agent->manager comms
-    from urlparse import urlparse
-
     server_url = urljoin(os.environ["IML_MANAGER_URL"], "agent")
     manager_address = socket.gethostbyname(urlparse(server_url).hostname)
     out = AgentShell.try_run(["/sbin/ip", "route", "get", manager_address])
-    match = re.search(r"dev\s+([^\s]+)", out)
+    match = IPROUTE_DEV_RE.search(out)
     if match:
         manager_dev = match.groups()[0]
     else:
@@ -99,53 +121,57 @@ def detect_ring1(ring0, ring1_address, ring1_prefix):
             "Only %s interfaces found" % len(all_interfaces)
         )
 
-    ring1_candidates = []
+    by_ip = dict((iface.ipv4_address, iface) for iface in all_interfaces)
 
-    # If the specified ring1 address is not already configured, get
-    # a list of ring1 candidates from the set of interfaces which
-    # are unconfigured and have positive link status.
-    if ring1_address not in [i.ipv4_address for i in all_interfaces]:
-        for iface in all_interfaces:
-            if not iface.ipv4_address and iface.has_link and not iface.is_slave:
-                ring1_candidates.append(iface)
+    # If the specified ring1 address is already configured then we just need
+    # to find a corosync multicast port. Otherwise, get a list of ring1
+    # candidates from the set of interfaces which are unconfigured and have
+    # positive link status. Probing for link may bring an interface up and
+    # poll it for several seconds, so do the cheap checks first and then
+    # probe the remainder together.
+    try:
+        iface = by_ip[ring1_address]
+    except KeyError:
+        unconfigured = [
+            iface
+            for iface in all_interfaces
+            if not iface.ipv4_address and not iface.is_slave
+        ]
+        link_states = get_link_states(unconfigured)
+        ring1_candidates = [iface for iface in unconfigured if link_states[iface.name]]
+
+        if len(ring1_candidates) > 1:
+            raise RingDetectionError(
+                "Unable to autodetect ring1: found %d unconfigured interfaces with link"
+                % len(ring1_candidates)
+            )
+        elif not ring1_candidates:
+            raise RingDetectionError("Failed to detect ring1 interface")
 
-    # If we've found exactly 1 unconfigured interface with link, we'll
-    # configure it as our ring1 interface.
-    if len(ring1_candidates) == 1:
+        # We've found exactly 1 unconfigured interface with link, so we'll
+        # configure it as our ring1 interface.
         iface = ring1_candidates[0]
         console_log.info("Chose %s for corosync ring1" % iface.name)
         iface.set_address(ring1_address, ring1_prefix)
-    elif len(ring1_candidates) > 1:
-        raise RingDetectionError(
-            "Unable to autodetect ring1: found %d unconfigured interfaces with link"
-            % len(ring1_candidates)
-        )
 
-    # Now, go back and look through the list of all interfaces again for
-    # our ring1 address. We do it this way in order to handle the situation
-    # where the ring1 interface was already configured and we just need to
-    # find a corosync multicast port.
-    for iface in all_interfaces:
         if iface.ipv4_address != ring1_address:
-            continue
+            raise RingDetectionError("Failed to detect ring1 interface")
 
-        # This toggles things like multicast group, etc.
-        iface.ringnumber = 0
+    # This toggles things like multicast group, etc.
+    iface.ringnumber = 0
 
-        # Now we need to agree on a mcastport for these peers.
-        # First we have to find a free one since we can't spend
-        # the time searching after deciding one is not being used
-        # already because that delays the discovery of us by our peer
-        iface.mcastport = find_unused_port(ring0)
-        console_log.info("Proposing %d for multicast port" % iface.mcastport)
+    # Now we need to agree on a mcastport for these peers.
+    # First we have to find a free one since we can't spend
+    # the time searching after deciding one is not being used
+    # already because that delays the discovery of us by our peer
+    iface.mcastport = find_unused_port(ring0)
+    console_log.info("Proposing %d for multicast port" % iface.mcastport)
 
-        # Now see if one is being used on ring1
-        discover_existing_mcastport(iface, timeout=30)
-        console_log.info("Decided on %d for multicast port" % iface.mcastport)
+    # Now see if one is being used on ring1
+    discover_existing_mcastport(iface, timeout=30)
+    console_log.info("Decided on %d for multicast port" % iface.mcastport)
 
-        return iface
-
-    raise RingDetectionError("Failed to detect ring1 interface")
+    return iface
 
 
 def find_subnet(network, prefixlen):
@@ -157,25 +183,30 @@ def find_subnet(network, prefixlen):
     10.128.0.0/9
     10.127.255.254/9
     10.255.255.255/32
+
+    prefixlen must be 9 or more (get_shared_ring rejects ring0 networks
+    larger than /9); a shorter prefix cannot fit in either half of 10/8
+    and the result is meaningless.
     """
-    _network = IPNetwork("%s/%s" % (network, prefixlen))
-    if IPNetwork("10.0.0.0/8") <= _network < IPAddress("10.255.255.255"):
-        if _network >= IPNetwork("10.128.0.0/9"):
-            shadow_network = IPNetwork("10.0.0.0/%s" % prefixlen)
-        else:
-            shadow_network = IPNetwork("10.128.0.0/%s" % prefixlen)
+    prefixlen = int(prefixlen)
+    netmask = (0xFFFFFFFF << (32 - prefixlen)) & 0xFFFFFFFF
+    first = struct.unpack("!I", socket.inet_aton(network))[0] & netmask
+
+    # Only a network in the lower half of 10/8 needs to move to the upper half
+    if TEN_8 <= first < TEN_128:
+        shadow_base = TEN_128
     else:
-        shadow_network = IPNetwork("10.0.0.0/%s" % prefixlen)
-    return shadow_network
+        shadow_base = TEN_8
 
+    return IPNetwork(
+        "%s/%s" % (socket.inet_ntoa(struct.pack("!I", shadow_base)), prefixlen)
+    )
 
-def find_unused_port(ring0, timeout=10, batch_count=10000):
-    from random import choice
 
+def find_unused_port(ring0, timeout=10, batch_count=10000):
     dest_addr = ring0.mcastaddr
     port_min = 32767
     port_max = 65535
-    ports = range(port_min, port_max, 2)
     portrange_str = "%s-%s" % (port_min, port_max)
 
     firewall_control.add_rule(
@@ -189,13 +220,12 @@ def find_unused_port(ring0, timeout=10, batch_count=10000):
             )
         )
 
+        # Let the kernel do the filtering (BPF) so that only the packets we
+        # care about are copied up and dissected by scapy.
         dports = sniff(
             iface=ring0.name,
-            lfilter=lambda x: x.haslayer(UDP)
-            and isinstance(x[UDP].dport, (int, long))
-            and x[UDP].dport >= port_min
-            and x[UDP].dport <= port_max
-            and x[IP].dst == dest_addr,
+            filter="udp and dst host %s and dst portrange %s"
+            % (dest_addr, portrange_str),
             timeout=timeout,
         )
 
@@ -203,19 +233,16 @@ def find_unused_port(ring0, timeout=10, batch_count=10000):
             "Finished after %d seconds, sniffed: %d" % (timeout, len(dports))
         )
 
-        for dport in set(dports):
-            try:
-                ports.remove(dport)
-            except ValueError:
-                # already removed
-                pass
+        used_ports = set(packet[UDP].dport for packet in dports)
 
     finally:
         firewall_control.remove_rule(
             0, "tcp", "find unused port", persist=False, address=ring0.mcastaddr
         )
 
-    return choice(ports)
+    return choice(
+        [port for port in xrange(port_min, port_max, 2) if port not in used_ports]
+    )
 
 
 def _corosync_listener(service, action):
@@ -258,17 +285,17 @@ def discover_existing_mcastport(ring1, timeout=10):
     ring1_original_mcast_port = ring1.mcastport
 
     try:
-        dports = sniff(
-            lfilter=lambda x: x.haslayer(UDP)
-            and isinstance(x[UDP].dport, (int, long))
-            and x[IP].dst == ring1.mcastaddr
-            and x[IP].src != ring1.ipv4_address,
+        # Filter in the kernel (BPF) rather than dissecting every packet on
+        # the interface in python; our own talker traffic is excluded too.
+        packets = sniff(
             iface=ring1.name,
+            filter="udp and dst host %s and not src host %s"
+            % (ring1.mcastaddr, ring1.ipv4_address),
             count=1,
             timeout=timeout,
         )
 
-        dports = map(lambda x: x[UDP].dport, dports)
+        dports = [packet[UDP].dport for packet in packets]
 
         console_log.debug(
             "Finished after %d seconds, sniffed: %d" % (timeout, len(dports))
@@ -290,21 +317,50 @@ def render_config(interfaces):
 
 
 def write_config_to_file(path, config):
-    import os
-    import errno
-    import shutil
-    from tempfile import mkstemp
+    """
+    Write config to path, keeping the previous version as path.old.
 
-    tmpf, tmpname = mkstemp()
-    os.write(tmpf, config)
+    :return: False if path already held exactly this config (nothing is written), True otherwise.
+    """
     try:
-        shutil.move(path, "%s.old" % path)
+        with open(path) as f:
+            if f.read() == config:
+                return False
     except IOError as e:
         if e.errno != errno.ENOENT:
             raise e
-    os.close(tmpf)
-    # no easier way to get a filename from a fd?!?
-    shutil.copy(tmpname, path)
+
+    # Create the new file alongside the old one so that it can be renamed
+    # into place, rename is atomic within a filesystem.
+    tmpf, tmpname = mkstemp(
+        dir=os.path.dirname(path), prefix="%s." % os.path.basename(path)
+    )
+    try:
+        try:
+            os.write(tmpf, config)
+            # Make sure the new contents are on disk before renaming them into place
+            os.fsync(tmpf)
+        finally:
+            os.close(tmpf)
+
+        # Hard link the current file to path.old rather than moving it, so that
+        # path never goes missing. If there is no current file then leave any
+        # existing path.old alone.
+        if os.path.exists(path):
+            old_path = "%s.old" % path
+            try:
+                os.remove(old_path)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise e
+            os.link(path, old_path)
+
+        os.rename(tmpname, path)
+    except Exception:
+        os.unlink(tmpname)
+        raise
+
+    return True
 
 
 class CorosyncRingInterface(object):
@@ -332,10 +388,15 @@ class CorosyncRingInterface(object):
         "IFF_UP",
     ]
 
-    def __init__(self, name, ringnumber=0, mcastport=0):
+    def __init__(self, name, ringnumber=0, mcastport=0, info=None):
         # ethtool does NOT like unicode
         self.name = str(name)
-        self.refresh()
+
+        if info is None:
+            self.refresh()
+        else:
+            self._set_info(info)
+
         self.ringnumber = ringnumber
         self.mcastport = mcastport
 
@@ -371,11 +432,13 @@ class CorosyncRingInterface(object):
             AgentShell.try_run(["/sbin/ip", "addr", "add", ifaddr, "dev", self.name])
 
             # The link address change is asynchronous, so we need to wait for the
-            # address to stick of we have a race condition.
+            # address to stick of we have a race condition. Check straight away
+            # and only sleep while the address has not yet appeared.
             timeout = 30
+            self.refresh()
             while self.ipv4_address != ipv4_address and timeout != 0:
-                self.refresh()
                 time.sleep(1)
+                self.refresh()
                 timeout -= 1
 
             if self.ipv4_address != ipv4_address:
@@ -395,7 +458,10 @@ class CorosyncRingInterface(object):
     def refresh(self):
         import ethtool
 
-        self._info = ethtool.get_interfaces_info(self.name)[0]
+        self._set_info(ethtool.get_interfaces_info(self.name)[0])
+
+    def _set_info(self, info):
+        self._info = info
         try:
             self._network = IPNetwork(
                 "%s/%s" % (self._info.ipv4_address, self._info.ipv4_netmask)
@@ -419,7 +485,11 @@ class CorosyncRingInterface(object):
     def ipv4_netmask(self):
         # etherinfo.ipv4_netmask returns a cidr prefix (e.g. 24), but
         # things like ifcfg want a subnet mask.
-        return str(IPNetwork("0.0.0.0/%s" % self._info.ipv4_netmask).netmask)
+        prefixlen = int(self._info.ipv4_netmask)
+        if not 0 <= prefixlen <= 32:
+            raise AddrFormatError("invalid IPv4 prefix length: %s" % prefixlen)
+
+        return PREFIX_TO_NETMASK[prefixlen]
 
     @property
     def mcastaddr(self):
@@ -438,50 +508,66 @@ class CorosyncRingInterface(object):
 
     @property
     def has_link(self):
-        old_link_state_up = self.is_up
+        return get_link_states([self])[self.name]
 
-        # HYD-2003: Some NICs require the interface to be in an UP state
-        # before link detection will work.
-        time_left = 0
 
-        if not self.is_up:
-            AgentShell.try_run(["/sbin/ip", "link", "set", "dev", self.name, "up"])
-            time_left = 10
+def _get_device_state(name):
+    try:
+        filepath = operstate.format(name)
+        if os.path.exists(filepath):
+            with open(filepath, "r") as f:
+                return f.read().strip()
+        else:
+            return "unknown"
+    except IOError:
+        print("Could not read state of ethernet device {}".format(name))
+        return "unknown"
 
-        def _get_device_state(name):
-            try:
-                filepath = operstate.format(name)
-                if os.path.exists(filepath):
-                    with open(filepath, "r") as f:
-                        return f.read().strip()
-                else:
-                    return "unknown"
-            except IOError:
-                print("Could not read state of ethernet device {}".format(name))
-                return "unknown"
-
-        def _has_link():
-            return _get_device_state(self.name) == "up"
 
-        try:
-            while time_left:
-                # Poll for link status on newly-up interfaces
-                if _has_link():
-                    return True
-                else:
-                    time.sleep(1)
-                    time_left -= 1
-
-            return _has_link()
-        except IOError:
-            # If the ioctl fails, then for the purposes of this test, the
-            # interface is not usable. HYD-2679
-            return False
-        finally:
-            if not old_link_state_up:
-                AgentShell.try_run(
-                    ["/sbin/ip", "link", "set", "dev", self.name, "down"]
-                )
+def get_link_states(interfaces, timeout=10):
+    """
+    Find out which of the given interfaces have link.
+
+    HYD-2003: Some NICs require the interface to be in an UP state before
+    link detection will work, so interfaces that are down are brought up,
+    polled for up to timeout seconds and then put back down. They are all
+    brought up before any polling starts so that their links negotiate
+    together, rather than one interface after another.
+
+    :return: dict of interface name to True if the interface has link
+    """
+    link_states = dict((iface.name, False) for iface in interfaces)
+    raised = []
+
+    try:
+        for iface in interfaces:
+            if not iface.is_up:
+                AgentShell.try_run(["/sbin/ip", "link", "set", "dev", iface.name, "up"])
+                raised.append(iface.name)
+
+        # Interfaces that were already up are only checked once
+        pending = list(link_states)
+        time_left = timeout
+
+        while True:
+            for name in pending:
+                link_states[name] = _get_device_state(name) == "up"
+
+            pending = [
+                name for name in pending if name in raised and not link_states[name]
+            ]
+
+            if not pending or not time_left:
+                break
+
+            # Poll for link status on newly-up interfaces
+            time.sleep(1)
+            time_left -= 1
+
+        return link_states
+    finally:
+        for name in raised:
+            AgentShell.try_run(["/sbin/ip", "link", "set", "dev", name, "down"])
 
 
 def corosync_running():
@@ -5,10 +5,10 @@
 import xml.etree.ElementTree as xml
 from xml.parsers.expat import ExpatError as ParseError
 import socket
+import time
 
 from chroma_agent.lib.shell import AgentShell
 from chroma_agent.lib import fence_agents
-from iml_common.lib import util
 from iml_common.lib.service_control import ServiceControl
 
 
@@ -293,25 +293,41 @@ class PacemakerConfig(object):
 
         return property_set.get(value_name, None)
 
+    @staticmethod
+    def _nvpairs(set_id, values):
+        return "".join(
+            '<nvpair id="%s-%s" name="%s" value="%s"/>\n' % (set_id, key, key, value)
+            for key, value in values.items()
+        )
+
     def create_update_properyset(self, propertyset_name, properties):
-        nvpairs = ""
+        cibadmin(
+            [
+                "--modify",
+                "--allow-create",
+                "-o",
+                "crm_config",
+                "-X",
+                '<cluster_property_set id="%s">\n%s'
+                % (propertyset_name, self._nvpairs(propertyset_name, properties)),
+            ]
+        )
 
-        for key, value in properties.items():
-            nvpairs += '<nvpair id="%s-%s" name="%s" value="%s"/>\n' % (
-                propertyset_name,
-                key,
-                key,
-                value,
-            )
+    def create_update_rsc_defaults(self, defaults):
+        # Use the same ids as 'crm_attribute --type rsc_defaults' (which is how
+        # these were set previously) so that an existing set is updated in
+        # place rather than a second set being created alongside it.
+        set_id = "rsc_defaults-options"
 
         cibadmin(
             [
                 "--modify",
                 "--allow-create",
                 "-o",
-                "crm_config",
+                "rsc_defaults",
                 "-X",
-                '<cluster_property_set id="%s">\n%s' % (propertyset_name, nvpairs),
+                '<meta_attributes id="%s">\n%s</meta_attributes>'
+                % (set_id, self._nvpairs(set_id, defaults)),
             ]
         )
 
@@ -353,15 +369,23 @@ def _cibadmin(command_args, timeout=120, raise_on_timeout=False):
     command_args.insert(0, "cibadmin")
     # NB: This isn't a "true" timeout, in that it won't forcibly stop the
     # subprocess after a timeout. We'd need more invasive changes to
-    # shell._run() for that.
-    for _ in util.wait(timeout):
+    # shell._run() for that. It is however measured against the wall clock,
+    # so time spent in cibadmin itself counts towards it.
+    deadline = time.time() + timeout
+    delay = 0.05
+
+    while True:
         result = AgentShell.run(command_args)
 
         if result.rc == 0:
             return result
-        elif result.rc not in RETRY_CODES:
+        elif result.rc not in RETRY_CODES or time.time() >= deadline:
             break
 
+        # Back off quickly at first, a busy CIB is usually free again soon.
+        time.sleep(delay)
+        delay = min(delay * 2, 2.0)
+
     if raise_on_timeout and result.rc in RETRY_CODES:
         raise PacemakerError(
             "%s timed out after %d seconds: rc: %s, stderr: %s"
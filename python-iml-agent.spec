@@ -71,6 +71,7 @@ Requires:       python-netaddr
 Requires:       python-ethtool
 Requires:       python-jinja2
 Requires:       python2-scapy
+Requires:       tcpdump
 Requires:       system-config-firewall-base
 Requires:       ed
 
@@ -0,0 +1,96 @@
+from collections import namedtuple
+
+import mock
+from django.utils import unittest
+
+from chroma_agent.action_plugins.detect_scan import LocalTargets, MgsTargets
+
+
+TargetsInfo = namedtuple("TargetsInfo", ["names", "params"])
+
+
+class TestLocalTargets(unittest.TestCase):
+    def setUp(self):
+        super(TestLocalTargets, self).setUp()
+
+        self.scanner_data = {
+            "blockDevices": {},
+            "localMounts": [
+                {"source": "/dev/sdb", "target": "/mnt/MGS", "fstype": "lustre"}
+            ],
+        }
+        self.scanner_cmd = mock.patch(
+            "chroma_agent.action_plugins.detect_scan.scanner_cmd",
+            return_value=self.scanner_data,
+        ).start()
+
+        self.targets = {
+            "/dev/sdb": TargetsInfo(["MGS"], {}),
+            "/dev/sdc": TargetsInfo(["testfs-OST0000"], {}),
+            "/dev/sdd": TargetsInfo([], None),
+            "/dev/mapper/mpathc": TargetsInfo(["testfs-OST0000"], {}),
+        }
+
+        def block_device(device_type, device_path):
+            block_device = mock.Mock()
+            block_device.targets.return_value = self.targets[device_path]
+            block_device.mgs_targets.return_value = {"testfs": [device_path]}
+            return block_device
+
+        mock.patch(
+            "chroma_agent.action_plugins.detect_scan.BlockDevice", block_device
+        ).start()
+
+        self.addCleanup(mock.patch.stopall)
+
+    def _device(self, path, uuid):
+        return {"type": "linux", "path": path, "uuid": uuid}
+
+    def test_single_scanner_query(self):
+        local_targets = LocalTargets(
+            [
+                self._device("/dev/sdb", "uuid-b"),
+                self._device("/dev/sdc", "uuid-c"),
+                self._device("/dev/sdd", "uuid-d"),
+            ]
+        )
+
+        self.scanner_cmd.assert_called_once_with("Stream")
+        self.assertEqual(
+            sorted((t["name"], t["mounted"]) for t in local_targets.targets),
+            [("MGS", True), ("testfs-OST0000", False)],
+        )
+
+    def test_no_devices(self):
+        self.assertEqual(LocalTargets([]).targets, [])
+        self.assertFalse(self.scanner_cmd.called)
+
+    def test_multipath_device_paths(self):
+        local_targets = LocalTargets(
+            [
+                self._device("/dev/sdc", "uuid-c"),
+                self._device("/dev/mapper/mpathc", "uuid-c"),
+            ]
+        )
+
+        self.assertEqual(len(local_targets.targets), 1)
+        self.assertEqual(
+            local_targets.targets[0]["device_paths"],
+            ["/dev/mapper/mpathc", "/dev/sdc"],
+        )
+        self.assertEqual(local_targets.by_name["testfs-OST0000"], local_targets.targets)
+
+    def test_mgs_targets(self):
+        local_targets = LocalTargets(
+            [self._device("/dev/sdb", "uuid-b"), self._device("/dev/sdc", "uuid-c")]
+        )
+
+        self.assertEqual(
+            MgsTargets(local_targets).filesystems, {"testfs": ["/dev/sdb"]}
+        )
+
+    def test_mgs_targets_unmounted(self):
+        self.scanner_data["localMounts"] = []
+        local_targets = LocalTargets([self._device("/dev/sdb", "uuid-b")])
+
+        self.assertEqual(MgsTargets(local_targets).filesystems, {})
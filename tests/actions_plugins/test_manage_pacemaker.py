@@ -0,0 +1,82 @@
+import mock
+from django.utils import unittest
+from iml_common.test.command_capture_testcase import (
+    CommandCaptureTestCase,
+    CommandCaptureCommand,
+)
+
+from chroma_agent.action_plugins import manage_pacemaker
+from chroma_agent.lib.pacemaker import PacemakerError
+
+
+class TestCrmNodes(CommandCaptureTestCase):
+    crm_node_list = "1 node1 member\n2 node2 lost\n3 node3 unknown\n"
+
+    def test_cluster_size(self):
+        self.add_command(("crm_node", "-l"), stdout=self.crm_node_list)
+
+        self.assertEqual(manage_pacemaker._get_cluster_size(), 2)
+        self.assertRanAllCommandsInOrder()
+
+    def test_cluster_size_no_nodes(self):
+        self.add_command(("crm_node", "-l"))
+
+        self.assertEqual(manage_pacemaker._get_cluster_size(), 0)
+        self.assertRanAllCommandsInOrder()
+
+    def test_delete_node(self):
+        self.add_commands(
+            CommandCaptureCommand(("crm_node", "-l"), stdout=self.crm_node_list),
+            CommandCaptureCommand(("crm_node", "--force", "-R", "2")),
+            CommandCaptureCommand(
+                ("cibadmin", "--delete", "--xpath", '//nodes/node[@uname="node2"]')
+            ),
+            CommandCaptureCommand(
+                (
+                    "cibadmin",
+                    "--delete",
+                    "--xpath",
+                    '//status/node_state[@uname="node2"]',
+                )
+            ),
+        )
+
+        manage_pacemaker.delete_node("node2")
+        self.assertRanAllCommandsInOrder()
+
+    def test_delete_unknown_node(self):
+        self.add_commands(
+            CommandCaptureCommand(("crm_node", "-l"), stdout=self.crm_node_list),
+            CommandCaptureCommand(
+                ("cibadmin", "--delete", "--xpath", '//nodes/node[@uname="node4"]')
+            ),
+            CommandCaptureCommand(
+                (
+                    "cibadmin",
+                    "--delete",
+                    "--xpath",
+                    '//status/node_state[@uname="node4"]',
+                )
+            ),
+        )
+
+        manage_pacemaker.delete_node("node4")
+        self.assertRanAllCommandsInOrder()
+
+
+class TestDoConfigurePacemaker(unittest.TestCase):
+    def setUp(self):
+        super(TestDoConfigurePacemaker, self).setUp()
+
+        mock.patch(
+            "chroma_agent.action_plugins.manage_pacemaker._unconfigure_fencing",
+            return_value=None,
+        ).start()
+        mock.patch("chroma_agent.action_plugins.manage_pacemaker.cibadmin").start()
+        self.addCleanup(mock.patch.stopall)
+
+    def test_rsc_defaults_timeout_returns_error(self):
+        pc = mock.Mock(nodes=[])
+        pc.create_update_rsc_defaults.side_effect = PacemakerError("cib busy")
+
+        self.assertEqual(manage_pacemaker._do_configure_pacemaker(pc), "cib busy")
@@ -1,5 +1,9 @@
+import os
+import shutil
 import sys
+import tempfile
 import mock
+from django.utils import unittest
 
 from iml_common.test.command_capture_testcase import (
     CommandCaptureTestCase,
@@ -24,8 +28,10 @@ class fake_ethtool(object):
     def __init__(self, interfaces={}):
         self.interfaces = interfaces
 
-    def get_interfaces_info(self, name):
-        return [FakeEtherInfo(self.interfaces[name])]
+    def get_interfaces_info(self, *names):
+        return [
+            FakeEtherInfo(self.interfaces[name]) for name in names or self.interfaces
+        ]
 
     def get_devices(self):
         return self.interfaces.keys()
@@ -44,6 +50,7 @@ class TestConfigureCorosync(CommandCaptureTestCase):
 
         from chroma_agent.lib.corosync import CorosyncRingInterface
         from chroma_agent.lib.corosync import env
+        from netaddr import IPNetwork
 
         def get_shared_ring():
             return CorosyncRingInterface("eth0.1.1?1b34*430")
@@ -55,7 +62,7 @@ class TestConfigureCorosync(CommandCaptureTestCase):
                 "device": "eth0.1.1?1b34*430",
                 "mac_address": "de:ad:be:ef:ca:fe",
                 "ipv4_address": "192.168.1.1",
-                "ipv4_netmask": "255.255.255.0",
+                "ipv4_netmask": 24,
                 "link_up": True,
             },
             "eth1": {
@@ -90,8 +97,12 @@ class TestConfigureCorosync(CommandCaptureTestCase):
 
         def set_address(obj, address, prefix):
             if self.interfaces[obj.name]["ipv4_address"] is None:
+                # ethtool reports the netmask as a prefix length, whichever
+                # form it was set with
                 self.interfaces[obj.name]["ipv4_address"] = address
-                self.interfaces[obj.name]["ipv4_netmask"] = prefix
+                self.interfaces[obj.name]["ipv4_netmask"] = IPNetwork(
+                    "0.0.0.0/%s" % prefix
+                ).prefixlen
             old_set_address(obj, address, prefix)
 
         mock.patch(
@@ -107,6 +118,17 @@ class TestConfigureCorosync(CommandCaptureTestCase):
         )
         self.link_patcher.start()
 
+        def get_link_states(interfaces):
+            return dict(
+                (iface.name, self.interfaces[iface.name]["link_up"])
+                for iface in interfaces
+            )
+
+        self.link_states_patcher = mock.patch(
+            "chroma_agent.lib.corosync.get_link_states", get_link_states
+        )
+        self.link_states_patcher.start()
+
         mock.patch(
             "chroma_agent.lib.corosync.find_unused_port", return_value=4242
         ).start()
@@ -470,11 +492,65 @@ class TestConfigureCorosync(CommandCaptureTestCase):
             ("10.128.0.0", "9"): IPNetwork("10.0.0.0/9"),
             ("10.127.255.254", "9"): IPNetwork("10.128.0.0/9"),
             ("10.255.255.255", "32"): IPNetwork("10.0.0.0/32"),
+            ("10.127.255.0", "24"): IPNetwork("10.128.0.0/24"),
+            ("10.128.0.0", "24"): IPNetwork("10.0.0.0/24"),
+            ("172.16.0.0", "12"): IPNetwork("10.0.0.0/12"),
         }
 
         for args, output in test_map.items():
             self.assertEqual(output, find_subnet(*args))
 
+    def test_generate_ring1_network(self):
+        from chroma_agent.lib.corosync import generate_ring1_network
+
+        ring0 = mock.Mock(
+            ipv4_network="192.168.1.0",
+            ipv4_prefixlen=24,
+            ipv4_address="192.168.1.37",
+            ipv4_hostmask="0.0.0.255",
+        )
+        self.assertEqual(generate_ring1_network(ring0), ("10.0.0.37", "24"))
+
+        ring0 = mock.Mock(
+            ipv4_network="10.0.0.0",
+            ipv4_prefixlen=12,
+            ipv4_address="10.3.2.1",
+            ipv4_hostmask="0.15.255.255",
+        )
+        self.assertEqual(generate_ring1_network(ring0), ("10.131.2.1", "12"))
+
+    def test_ipv4_netmask(self):
+        from netaddr.core import AddrFormatError
+        from chroma_agent.lib.corosync import CorosyncRingInterface
+
+        def netmask(prefixlen):
+            info = FakeEtherInfo(
+                {"ipv4_address": "192.168.1.1", "ipv4_netmask": prefixlen}
+            )
+            return CorosyncRingInterface("eth0", info=info).ipv4_netmask
+
+        self.assertEqual(netmask(24), "255.255.255.0")
+        self.assertEqual(netmask(0), "0.0.0.0")
+        self.assertEqual(netmask(32), "255.255.255.255")
+        self.assertRaises(AddrFormatError, netmask, -1)
+        self.assertRaises(AddrFormatError, netmask, 33)
+
+    def test_get_all_interfaces(self):
+        from chroma_agent.lib.corosync import get_all_interfaces
+
+        ethtool = sys.modules["ethtool"]
+
+        with mock.patch.object(
+            ethtool, "get_interfaces_info", wraps=ethtool.get_interfaces_info
+        ) as get_interfaces_info:
+            interfaces = get_all_interfaces()
+
+        get_interfaces_info.assert_called_once_with()
+        self.assertEqual(
+            sorted((i.name, i.ipv4_address) for i in interfaces),
+            [("eth0.1.1?1b34*430", "192.168.1.1"), ("eth1", None)],
+        )
+
     def test_link_state_unknown(self):
         with mock.patch("__builtin__.open", mock.mock_open(read_data="unknown")):
             with mock.patch(
@@ -483,6 +559,7 @@ class TestConfigureCorosync(CommandCaptureTestCase):
             ):
                 with mock.patch("os.path.exists", return_value=True):
                     self.link_patcher.stop()
+                    self.link_states_patcher.stop()
 
                     from chroma_agent.lib.corosync import get_shared_ring
 
@@ -501,3 +578,174 @@ class TestConfigureCorosync(CommandCaptureTestCase):
                     self.assertFalse(iface.has_link)
 
                     self.assertRanAllCommandsInOrder()
+
+    def test_detect_ring1_already_configured(self):
+        from chroma_agent.lib.corosync import detect_ring1
+
+        self.interfaces["eth1"]["ipv4_address"] = "10.0.0.1"
+        self.interfaces["eth1"]["ipv4_netmask"] = "24"
+
+        with mock.patch("chroma_agent.lib.corosync.get_link_states") as link_states:
+            ring1 = detect_ring1(mock.Mock(), "10.0.0.1", "24")
+
+        self.assertFalse(link_states.called)
+        self.assertFalse(self.write_ifcfg.called)
+        self.assertEqual(ring1.name, "eth1")
+        self.assertEqual(ring1.mcastport, 4242)
+
+    def test_get_link_states_probes_together(self):
+        self.link_states_patcher.stop()
+
+        from chroma_agent.lib.corosync import get_link_states
+
+        eth1 = mock.Mock(is_up=False)
+        eth1.name = "eth1"
+        eth2 = mock.Mock(is_up=False)
+        eth2.name = "eth2"
+        eth3 = mock.Mock(is_up=True)
+        eth3.name = "eth3"
+
+        # eth1 gets link on the second poll, eth2 never does
+        device_states = {"eth1": ["down", "up"], "eth2": ["down"] * 3, "eth3": ["up"]}
+
+        self.add_commands(
+            CommandCaptureCommand(("/sbin/ip", "link", "set", "dev", "eth1", "up")),
+            CommandCaptureCommand(("/sbin/ip", "link", "set", "dev", "eth2", "up")),
+            CommandCaptureCommand(("/sbin/ip", "link", "set", "dev", "eth1", "down")),
+            CommandCaptureCommand(("/sbin/ip", "link", "set", "dev", "eth2", "down")),
+        )
+
+        with mock.patch(
+            "chroma_agent.lib.corosync._get_device_state",
+            side_effect=lambda name: device_states[name].pop(0),
+        ), mock.patch("chroma_agent.lib.corosync.time.sleep") as sleep:
+            link_states = get_link_states([eth1, eth2, eth3], timeout=2)
+
+        self.assertEqual(link_states, {"eth1": True, "eth2": False, "eth3": True})
+        self.assertEqual(sleep.call_count, 2)
+        self.assertRanAllCommandsInOrder()
+
+
+class TestFindUnusedPort(unittest.TestCase):
+    def setUp(self):
+        super(TestFindUnusedPort, self).setUp()
+
+        mock.patch("chroma_agent.lib.corosync.firewall_control").start()
+        self.addCleanup(mock.patch.stopall)
+
+    def test_sniffed_ports_not_chosen(self):
+        from scapy.all import UDP
+        from chroma_agent.lib.corosync import find_unused_port
+
+        ring0 = mock.Mock(mcastaddr="226.94.0.1")
+        ring0.name = "eth0"
+
+        # Every odd port in the range is in use apart from 40001
+        packets = [
+            {UDP: mock.Mock(dport=port)}
+            for port in range(32767, 65535, 2)
+            if port != 40001
+        ]
+
+        with mock.patch("chroma_agent.lib.corosync.sniff", return_value=packets):
+            self.assertEqual(find_unused_port(ring0), 40001)
+
+
+class TestDiscoverExistingMcastport(unittest.TestCase):
+    def setUp(self):
+        super(TestDiscoverExistingMcastport, self).setUp()
+
+        mock.patch("chroma_agent.lib.corosync._start_talker_thread").start()
+        self.stop_talker_thread = mock.patch(
+            "chroma_agent.lib.corosync._stop_talker_thread"
+        ).start()
+        self.addCleanup(mock.patch.stopall)
+
+        self.ring1 = mock.Mock(
+            mcastaddr="226.94.0.1", ipv4_address="10.0.0.1", mcastport=40001
+        )
+        self.ring1.name = "eth1"
+
+    def test_existing_port_adopted(self):
+        from scapy.all import UDP
+        from chroma_agent.lib.corosync import discover_existing_mcastport
+
+        with mock.patch(
+            "chroma_agent.lib.corosync.sniff",
+            return_value=[{UDP: mock.Mock(dport=50001)}],
+        ) as sniff:
+            discover_existing_mcastport(self.ring1, timeout=5)
+
+        sniff.assert_called_once_with(
+            iface="eth1",
+            filter="udp and dst host 226.94.0.1 and not src host 10.0.0.1",
+            count=1,
+            timeout=5,
+        )
+        self.assertEqual(self.ring1.mcastport, 50001)
+        self.assertEqual(self.stop_talker_thread.call_count, 2)
+
+    def test_nothing_sniffed(self):
+        from chroma_agent.lib.corosync import discover_existing_mcastport
+
+        with mock.patch("chroma_agent.lib.corosync.sniff", return_value=[]):
+            discover_existing_mcastport(self.ring1, timeout=5)
+
+        self.assertEqual(self.ring1.mcastport, 40001)
+        self.assertEqual(self.stop_talker_thread.call_count, 1)
+
+
+class TestWriteConfigToFile(unittest.TestCase):
+    def setUp(self):
+        super(TestWriteConfigToFile, self).setUp()
+
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.path = os.path.join(self.tmpdir, "corosync.conf")
+
+    def _read(self, path):
+        with open(path) as f:
+            return f.read()
+
+    def test_write_new_config(self):
+        from chroma_agent.lib.corosync import write_config_to_file
+
+        self.assertTrue(write_config_to_file(self.path, "totem {}\n"))
+        self.assertEqual(self._read(self.path), "totem {}\n")
+
+    def test_write_changed_config(self):
+        from chroma_agent.lib.corosync import write_config_to_file
+
+        write_config_to_file(self.path, "totem {}\n")
+
+        self.assertTrue(write_config_to_file(self.path, "totem { token: 1 }\n"))
+        self.assertEqual(self._read(self.path), "totem { token: 1 }\n")
+        self.assertEqual(self._read("%s.old" % self.path), "totem {}\n")
+
+    def test_write_unchanged_config(self):
+        from chroma_agent.lib.corosync import write_config_to_file
+
+        write_config_to_file(self.path, "totem {}\n")
+
+        self.assertFalse(write_config_to_file(self.path, "totem {}\n"))
+        self.assertFalse(os.path.exists("%s.old" % self.path))
+
+    def test_write_new_config_keeps_old(self):
+        from chroma_agent.lib.corosync import write_config_to_file
+
+        with open("%s.old" % self.path, "w") as f:
+            f.write("totem {}\n")
+
+        self.assertTrue(write_config_to_file(self.path, "totem { token: 1 }\n"))
+        self.assertEqual(self._read("%s.old" % self.path), "totem {}\n")
+
+    def test_write_failure_removes_temp_file(self):
+        from chroma_agent.lib.corosync import write_config_to_file
+
+        write_config_to_file(self.path, "totem {}\n")
+
+        with self.assertRaises(UnicodeEncodeError):
+            write_config_to_file(self.path, u"totem { \u2603 }\n")
+
+        self.assertEqual(os.listdir(self.tmpdir), ["corosync.conf"])
+        self.assertEqual(self._read(self.path), "totem {}\n")
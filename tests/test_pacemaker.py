@@ -0,0 +1,75 @@
+import mock
+from chroma_agent.lib import pacemaker
+from iml_common.test.command_capture_testcase import (
+    CommandCaptureTestCase,
+    CommandCaptureCommand,
+)
+
+
+class TestCibadmin(CommandCaptureTestCase):
+    def setUp(self):
+        super(TestCibadmin, self).setUp()
+
+        self.time = mock.patch("chroma_agent.lib.pacemaker.time.time").start()
+        self.sleep = mock.patch("chroma_agent.lib.pacemaker.time.sleep").start()
+        self.addCleanup(mock.patch.stopall)
+
+    def test_retry_then_success(self):
+        self.time.return_value = 0
+        self.single_commands(
+            CommandCaptureCommand(("cibadmin", "--query"), rc=10),
+            CommandCaptureCommand(("cibadmin", "--query"), stdout="<cib/>"),
+        )
+
+        result = pacemaker._cibadmin(["--query"])
+
+        self.assertEqual(result.rc, 0)
+        self.assertEqual(result.stdout, "<cib/>")
+        self.sleep.assert_called_once_with(0.05)
+        self.assertRanAllCommandsInOrder()
+
+    def test_no_retry_on_other_error(self):
+        self.time.return_value = 0
+        self.add_command(("cibadmin", "--query"), rc=1)
+
+        result = pacemaker._cibadmin(["--query"])
+
+        self.assertEqual(result.rc, 1)
+        self.assertFalse(self.sleep.called)
+        self.assertRanAllCommandsInOrder()
+
+    def test_retry_code_at_deadline_raises(self):
+        # The deadline is set at time 0 and has passed by the first check
+        self.time.side_effect = [0, 120]
+        self.add_command(("cibadmin", "--query"), rc=62)
+
+        with self.assertRaises(pacemaker.PacemakerError):
+            pacemaker.cibadmin(["--query"])
+
+        self.assertFalse(self.sleep.called)
+        self.assertRanAllCommandsInOrder()
+
+
+class TestRscDefaults(CommandCaptureTestCase):
+    def test_create_update_rsc_defaults(self):
+        self.add_commands(
+            CommandCaptureCommand(("cibadmin", "--query", "--local")),
+            CommandCaptureCommand(
+                (
+                    "cibadmin",
+                    "--modify",
+                    "--allow-create",
+                    "-o",
+                    "rsc_defaults",
+                    "-X",
+                    '<meta_attributes id="rsc_defaults-options">\n'
+                    '<nvpair id="rsc_defaults-options-resource-stickiness" name="resource-stickiness" value="1000"/>\n'
+                    "</meta_attributes>",
+                )
+            ),
+        )
+
+        pacemaker.PacemakerConfig().create_update_rsc_defaults(
+            {"resource-stickiness": "1000"}
+        )
+        self.assertRanAllCommandsInOrder()